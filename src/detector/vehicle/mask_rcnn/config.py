@@ -44,6 +44,23 @@ class Config(object):
 
     TRAIN_BN = False  # Defaulting to False since batch size is often small
 
+    # Run convolutions in float16 to use Tensor Cores. Proposal, detection
+    # and model output layers stay in float32. Only enable it on GPUs with
+    # compute capability 7.0 or higher, float16 is slower on CPU and older GPUs.
+    MIXED_PRECISION = False
+
+    # Convert detections and masks to the original image size inside the model
+    # graph instead of with NumPy on the host. All images in a batch must then
+    # have the same size. Off by default: the model then outputs
+    # DETECTION_MAX_INSTANCES full size masks per image instead of small ones,
+    # which may cost more to copy from the device than it saves.
+    UNMOLD_IN_GRAPH = False
+
+    # Let XLA auto-cluster and compile the ops it supports. Off by default:
+    # proposal and detection outputs have data dependent shapes, so clusters
+    # after them may be recompiled for new shapes, stalling the video loop.
+    XLA_AUTO_JIT = False
+
     def __init__(self, num_classes: int):
         self.BATCH_SIZE = self.IMAGES_PER_GPU * self.GPU_COUNT
         self.IMAGE_SHAPE = np.array(
@@ -98,7 +98,7 @@ def rpn_graph(feature_map, anchors_per_location, anchor_stride):
             )(x)
 
     # Softmax on last dimension of BG/FG.
-    rpn_probs = Activation("softmax", name="rpn_class_xxx")(rpn_class_logits)
+    rpn_probs = Activation("softmax", name="rpn_class_xxx", dtype='float32')(rpn_class_logits)
 
     # Bounding box refinement. [batch, H, W, anchors per location * depth]
     # where depth is [x, y, log(w), log(h)]
@@ -164,7 +164,8 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     # Shape: [batch, num_rois, POOL_SIZE, POOL_SIZE, channels]
     x = PyramidROIAlign(
             [pool_size, pool_size],
-            name="roi_align_classifier"
+            name="roi_align_classifier",
+            dtype='float32'
             )([rois, image_meta] + feature_maps)
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = TimeDistributed(
@@ -191,7 +192,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
             name='mrcnn_class_logits'
             )(shared)
     mrcnn_probs = TimeDistributed(
-            Activation("softmax"),
+            Activation("softmax", dtype='float32'),
             name="mrcnn_class"
             )(mrcnn_class_logits)
 
@@ -203,7 +204,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
             )(shared)
     # Reshape to [batch, num_rois, NUM_CLASSES, (dy, dx, log(dh), log(dw))]
 
-    mrcnn_bbox = Reshape((-1, num_classes, 4), name="mrcnn_bbox")(x)
+    mrcnn_bbox = Reshape((-1, num_classes, 4), name="mrcnn_bbox", dtype='float32')(x)
 
     return mrcnn_class_logits, mrcnn_probs, mrcnn_bbox
 
@@ -228,7 +229,8 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     # Shape: [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, channels]
     x = PyramidROIAlign(
             [pool_size, pool_size],
-            name="roi_align_mask"
+            name="roi_align_mask",
+            dtype='float32'
             )([rois, image_meta] + feature_maps)
 
     # Conv layers
@@ -277,7 +279,7 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
             name="mrcnn_mask_deconv"
             )(x)
     x = TimeDistributed(
-            Conv2D(num_classes, (1, 1), strides=1, activation="sigmoid"),
+            Conv2D(num_classes, (1, 1), strides=1, activation="sigmoid", dtype='float32'),
             name="mrcnn_mask"
             )(x)
     return x
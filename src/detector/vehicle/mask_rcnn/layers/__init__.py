@@ -1,9 +1,11 @@
 from .detection import DetectionLayer
 from .proposal import ProposalLayer
 from .roi_align import PyramidROIAlign
+from .unmold import UnmoldLayer
 
 __all__ = (
     DetectionLayer,
     ProposalLayer,
     PyramidROIAlign,
+    UnmoldLayer,
     )
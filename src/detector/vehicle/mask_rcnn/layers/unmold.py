@@ -0,0 +1,44 @@
+import tensorflow as tf
+
+from src.detector.vehicle.mask_rcnn.utils import (
+    batch_slice,
+    unmold_detections_graph,
+    )
+
+
+class UnmoldLayer(tf.keras.layers.Layer):
+    """Converts detections and masks to the original image coordinates and size,
+    so the post-processing runs on the same device as the rest of the model.
+    All images in a batch must have the same original size.
+
+    Inputs:
+        detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
+        mrcnn_mask: [batch, num_detections, height, width] masks of the detected classes
+        image_meta: [batch, (metadata)] Image details. See compose_image_meta()
+
+    Returns, zero padded to DETECTION_MAX_INSTANCES:
+        boxes: [batch, num_detections, (y1, x1, y2, x2)] in pixels
+        class_ids: [batch, num_detections]. Padding has class ID 0.
+        scores: [batch, num_detections]
+        masks: [batch, height, width, num_detections] bool instance masks
+    """
+
+    def __init__(self, config=None, **kwargs):
+        super(UnmoldLayer, self).__init__(**kwargs)
+        self.config = config
+
+    def call(self, inputs):
+        detections = inputs[0]
+        mrcnn_mask = inputs[1]
+        image_meta = inputs[2]
+
+        return batch_slice(
+                [detections, mrcnn_mask, image_meta],
+                lambda x, y, z: unmold_detections_graph(x, y, z, self.config),
+                self.config.IMAGES_PER_GPU,
+                names=["unmold_boxes", "unmold_class_ids", "unmold_scores", "unmold_masks"]
+                )
+
+    def compute_output_shape(self, input_shape):
+        n = self.config.DETECTION_MAX_INSTANCES
+        return [(None, n, 4), (None, n), (None, n), (None, None, None, n)]
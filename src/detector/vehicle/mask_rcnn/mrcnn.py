@@ -1,4 +1,13 @@
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import tensorflow as tf
 import tensorflow.keras.layers as KL
 import tensorflow.keras.models as KM
 
@@ -11,6 +20,7 @@ from .graphs import (
 from .layers import (
     DetectionLayer,
     ProposalLayer,
+    UnmoldLayer,
     )
 from .utils import (
     compose_image_meta,
@@ -20,9 +30,11 @@ from .utils import (
     mold_image,
     norm_boxes,
     resize_image,
-    unmold_mask,
+    unmold_masks,
     )
 
+logger = logging.getLogger(__name__)
+
 
 class MaskRCNN:
     """Encapsulates the Mask RCNN model functionality.
@@ -36,7 +48,39 @@ class MaskRCNN:
         config: A Sub-class of the Config class
         """
         self.config = config
-        self.keras_model = self.build(config)
+        # Layers take the global dtype policy when they are created. Box and
+        # score layers are pinned to float32 in build().
+        policy = tf.keras.mixed_precision.experimental.global_policy()
+        if config.MIXED_PRECISION:
+            tf.keras.mixed_precision.experimental.set_policy('mixed_float16')
+        try:
+            self.keras_model = self.build(config)
+        finally:
+            tf.keras.mixed_precision.experimental.set_policy(policy)
+        if config.XLA_AUTO_JIT:
+            tf.config.optimizer.set_jit(True)
+        # Graph function of the model with the model input shapes, so it's
+        # traced once when they are static and once per image size otherwise.
+        self._predict_fn = tf.function(
+                lambda images, image_metas, anchors: self.keras_model(
+                        [images, image_metas, anchors], training=False
+                        ),
+                input_signature=[
+                    tf.TensorSpec([config.BATCH_SIZE] + t.shape[1:].as_list(), tf.float32)
+                    for t in self.keras_model.inputs
+                    ]
+                )
+        # compose_image_meta() copies it into a new array, so it can be shared
+        self._active_class_ids = np.zeros([config.NUM_CLASSES], dtype=np.int32)
+        self._anchor_cache = {}
+        # Directory to persist generated anchors to, see load_weights()
+        self._anchors_dir = None
+        # Resizing and normalization release the GIL, so threads are enough
+        # to mold the images of a batch in parallel.
+        self._pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        # TensorRT optimized model, see to_tensorrt()
+        self._trt_model = None
+        self._trt_fn = None
 
     @staticmethod
     def build(config):
@@ -55,14 +99,26 @@ class MaskRCNN:
                     )
 
         # Inputs
-        input_image = KL.Input(
-                shape=[None, None, config.IMAGE_SHAPE[2]], name="input_image"
-                )
+        # Square mode always molds images to IMAGE_SHAPE, so the image and
+        # anchor shapes can be static. Other modes keep the input image size.
+        if config.IMAGE_RESIZE_MODE == "square":
+            image_shape = list(config.IMAGE_SHAPE)
+            anchor_count = generate_pyramid_anchors(
+                    config.RPN_ANCHOR_SCALES,
+                    config.RPN_ANCHOR_RATIOS,
+                    compute_backbone_shapes(config, config.IMAGE_SHAPE),
+                    config.BACKBONE_STRIDES,
+                    config.RPN_ANCHOR_STRIDE
+                    ).shape[0]
+        else:
+            image_shape = [None, None, config.IMAGE_SHAPE[2]]
+            anchor_count = None
+        input_image = KL.Input(shape=image_shape, name="input_image")
         input_image_meta = KL.Input(
                 shape=[config.IMAGE_META_SIZE],
                 name="input_image_meta"
                 )
-        input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
+        input_anchors = KL.Input(shape=[anchor_count, 4], name="input_anchors")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
@@ -126,7 +182,7 @@ class MaskRCNN:
         # e.g. [[a1, b1, c1], [a2, b2, c2]] => [[a1, a2], [b1, b2], [c1, c2]]
         output_names = ["rpn_class_logits", "rpn_class", "rpn_bbox"]
         outputs = list(zip(*layer_outputs))
-        outputs = [KL.Concatenate(axis=1, name=n)(list(o))
+        outputs = [KL.Concatenate(axis=1, name=n, dtype='float32')(list(o))
                    for o, n in zip(outputs, output_names)]
 
         rpn_class_logits, rpn_class, rpn_bbox = outputs
@@ -139,7 +195,8 @@ class MaskRCNN:
                 proposal_count=proposal_count,
                 nms_threshold=config.RPN_NMS_THRESHOLD,
                 name="ROI",
-                config=config
+                config=config,
+                dtype='float32'
                 )([rpn_class, rpn_bbox, anchors])
 
         # Network Heads
@@ -155,12 +212,12 @@ class MaskRCNN:
         # Detections
         # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in
         # normalized coordinates
-        detections = DetectionLayer(config, name="mrcnn_detection")(
+        detections = DetectionLayer(config, name="mrcnn_detection", dtype='float32')(
                 [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta]
                 )
 
         # Create masks for detections
-        detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
+        detection_boxes = KL.Lambda(lambda x: x[..., :4], dtype='float32')(detections)
         mrcnn_mask = build_fpn_mask_graph(
                 detection_boxes, mrcnn_feature_maps,
                 input_image_meta,
@@ -168,11 +225,26 @@ class MaskRCNN:
                 config.NUM_CLASSES,
                 train_bn=config.TRAIN_BN
                 )
+        # Keep only the mask of the class of each detection, so the model
+        # doesn't output masks of all the classes.
+        # [batch, num_detections, MASK_HEIGHT, MASK_WIDTH]
+        mrcnn_mask = KL.Lambda(
+                lambda x: tf.gather(x[0], tf.cast(x[1][..., 4], tf.int32), axis=4, batch_dims=2),
+                name="mrcnn_detection_mask",
+                dtype='float32'
+                )([mrcnn_mask, detections])
+
+        outputs = [detections, mrcnn_class, mrcnn_bbox,
+                   mrcnn_mask, rpn_rois, rpn_class, rpn_bbox]
+        if config.UNMOLD_IN_GRAPH:
+            # Final boxes, class IDs, scores and full size masks
+            outputs += UnmoldLayer(config, name="mrcnn_unmold", dtype='float32')(
+                    [detections, mrcnn_mask, input_image_meta]
+                    )
 
         model = KM.Model(
                 [input_image, input_image_meta, input_anchors],
-                [detections, mrcnn_class, mrcnn_bbox,
-                 mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
+                outputs,
                 name='mask_rcnn'
                 )
 
@@ -186,6 +258,115 @@ class MaskRCNN:
         """
         self.keras_model.load_weights(filepath=filepath, by_name=by_name)
 
+        # Persist anchors next to the weights and load the ones generated
+        # by previous runs
+        self._anchors_dir = os.path.dirname(filepath)
+        for path in glob.glob(self._anchors_path('*')):
+            try:
+                with np.load(path) as f:
+                    self._cache_anchors(tuple(f['shape'].tolist()), f['anchors'])
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                # They are regenerated on demand, so drop unreadable files
+                logger.warning("Removing unreadable anchors file %s", path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def to_tensorrt(self, images, saved_model_dir, precision_mode='FP16', workspace=1 << 30,
+                    calibration_batches=None
+                    ):
+        """Converts the Keras model to a TensorRT optimized SavedModel and
+        runs the detection with it from now on. The Keras model stays as is.
+        The built engines are saved with the model, so load_tensorrt() reuses
+        them (and the INT8 calibration) on the next start.
+
+        images: List of BATCH_SIZE representative images. TensorRT engines
+            are built for their molded shape.
+        saved_model_dir: Directory to save the Keras and the converted models to.
+        precision_mode: One of "FP32", "FP16" or "INT8".
+        workspace: Maximum TensorRT workspace size in bytes.
+        calibration_batches: INT8 only. Iterable of lists of BATCH_SIZE real
+            images, held out from the detection. About 100 batches is enough.
+        """
+        int8 = precision_mode == 'INT8'
+        if int8 and calibration_batches is None:
+            raise Exception("INT8 precision mode requires calibration batches")
+
+        keras_model_dir = os.path.join(saved_model_dir, 'keras')
+        trt_model_dir = os.path.join(saved_model_dir, 'trt')
+        self.keras_model.save(keras_model_dir, save_format='tf')
+
+        def feeds_fn(batches):
+            def input_fn():
+                for batch in batches:
+                    molded_images, image_metas, _ = self.mold_inputs(batch)
+                    feeds = self._signature_feeds(
+                            molded_images, image_metas, self.get_anchors(molded_images.shape[1:])
+                            )
+                    # Signature functions take positional inputs ordered by name
+                    yield [feeds[name] for name in sorted(feeds)]
+
+            return input_fn
+
+        converter = tf.experimental.tensorrt.Converter(
+                input_saved_model_dir=keras_model_dir,
+                conversion_params=tf.experimental.tensorrt.ConversionParams(
+                        precision_mode=precision_mode,
+                        max_workspace_size_bytes=workspace,
+                        use_calibration=int8,
+                        )
+                )
+        # TF-TRT calibrates INT8 ranges while converting, not while building
+        converter.convert(calibration_input_fn=feeds_fn(calibration_batches) if int8 else None)
+        converter.build(input_fn=feeds_fn([images]))
+        converter.save(trt_model_dir)
+        self.load_tensorrt(trt_model_dir)
+
+    def load_tensorrt(self, saved_model_dir):
+        """Loads a model saved by to_tensorrt() and runs the detection with it."""
+        # Keep the loaded object alive, signatures don't own its variables
+        self._trt_model = tf.saved_model.load(saved_model_dir)
+        self._trt_fn = self._trt_model.signatures['serving_default']
+
+    def _signature_feeds(self, molded_images, image_metas, anchors):
+        """Maps the model inputs to the input names of its SavedModel signature."""
+        return dict(zip(self.keras_model.input_names, [molded_images, image_metas, anchors]))
+
+    def _predict(self, molded_images, image_metas, anchors):
+        """Runs the model on molded inputs.
+
+        Uses the TensorRT model if one has been loaded and falls back to the
+        Keras model otherwise. Returns the model outputs as Numpy arrays.
+        """
+        if self._trt_fn is None:
+            # Call the model directly, predict() sets up a data pipeline and
+            # callbacks on every call, which is too much for a single batch
+            outputs = self._predict_fn(molded_images, image_metas, anchors)
+            return [o.numpy() for o in outputs]
+
+        feeds = self._signature_feeds(molded_images, image_metas, anchors)
+        outputs = self._trt_fn(**{name: tf.constant(x) for name, x in feeds.items()})
+        return [outputs[name].numpy() for name in self.keras_model.output_names]
+
+    def _mold_image(self, image):
+        """Resizes and normalizes a single image.
+
+        Returns the molded image, its image_meta and its window.
+        """
+        molded_image, window, scale, padding, crop = resize_image(
+                image,
+                min_dim=self.config.IMAGE_MIN_DIM,
+                min_scale=self.config.IMAGE_MIN_SCALE,
+                max_dim=self.config.IMAGE_MAX_DIM,
+                mode=self.config.IMAGE_RESIZE_MODE
+                )
+        image_meta = compose_image_meta(
+                0, image.shape, molded_image.shape, window, scale,
+                self._active_class_ids
+                )
+        return mold_image(molded_image, self.config), image_meta, window
+
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
@@ -198,32 +379,26 @@ class MaskRCNN:
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
         """
-        molded_images = []
-        image_metas = []
-        windows = []
-        for image in images:
-            # Resize image
-            molded_image, window, scale, padding, crop = resize_image(
-                    image,
-                    min_dim=self.config.IMAGE_MIN_DIM,
-                    min_scale=self.config.IMAGE_MIN_SCALE,
-                    max_dim=self.config.IMAGE_MAX_DIM,
-                    mode=self.config.IMAGE_RESIZE_MODE
-                    )
-            molded_image = mold_image(molded_image, self.config)
-            # Build image_meta
-            image_meta = compose_image_meta(
-                    0, image.shape, molded_image.shape, window, scale,
-                    np.zeros([self.config.NUM_CLASSES], dtype=np.int32)
-                    )
-            # Append
-            molded_images.append(molded_image)
-            windows.append(window)
-            image_metas.append(image_meta)
-        # Pack into arrays
-        molded_images = np.stack(molded_images)
-        image_metas = np.stack(image_metas)
-        windows = np.stack(windows)
+        # Mold images in parallel, a single image isn't worth the dispatch
+        if len(images) > 1:
+            results = self._pool.map(self._mold_image, images)
+        else:
+            results = map(self._mold_image, images)
+
+        molded_images = None
+        image_metas = np.empty((len(images), self.config.IMAGE_META_SIZE), dtype=np.float32)
+        windows = np.empty((len(images), 4), dtype=np.int32)
+        for i, (molded_image, image_meta, window) in enumerate(results):
+            # The molded size is only known after resizing (IMAGE_RESIZE_MODE
+            # 'none' keeps the input size), so allocate on the first image.
+            if molded_images is None:
+                molded_images = np.empty((len(images),) + molded_image.shape, dtype=np.float32)
+            # All images in a batch MUST be of the same size
+            assert molded_image.shape == molded_images.shape[1:], \
+                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
+            molded_images[i] = molded_image
+            image_metas[i] = image_meta
+            windows[i] = window
         return molded_images, image_metas, windows
 
     @staticmethod
@@ -235,7 +410,7 @@ class MaskRCNN:
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width] masks of the detected classes
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
@@ -249,51 +424,60 @@ class MaskRCNN:
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
-        zero_ix = np.where(detections[:, 4] == 0)[0]
-        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+        is_padding = detections[:, 4] == 0
+        N = is_padding.argmax() if is_padding.any() else detections.shape[0]
 
-        # Extract boxes, class_ids, scores, and class-specific masks
+        # Extract boxes, class_ids, scores, and masks
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        masks = mrcnn_mask[:N]
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
         window = norm_boxes(window, image_shape[:2])
-        wy1, wx1, wy2, wx2 = window
-        shift = np.array([wy1, wx1, wy1, wx1])
-        wh = wy2 - wy1  # window height
-        ww = wx2 - wx1  # window width
-        scale = np.array([wh, ww, wh, ww])
-        # Convert boxes to normalized coordinates on the window
-        boxes = np.divide(boxes - shift, scale)
-        # Convert boxes to pixel coordinates on the original image
+        # (wy1, wx1, wy1, wx1) and (window height, window width) twice
+        shift = window[[0, 1, 0, 1]]
+        scale = window[[2, 3, 2, 3]] - shift
+        # Convert boxes to normalized coordinates on the window. Work in place
+        # on the single copy made by the subtraction.
+        boxes = np.subtract(boxes, shift)
+        np.divide(boxes, scale, out=boxes)
+        # Convert boxes to pixel coordinates on the original image. Not in
+        # place, so the rounding is done in float64 as before.
         boxes = denorm_boxes(boxes, original_image_shape[:2])
 
         # Filter out detections with zero area. Happens in early training when
         # network weights are still random
-        exclude_ix = np.where(
-                (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0
-                )[0]
-        if exclude_ix.shape[0] > 0:
-            boxes = np.delete(boxes, exclude_ix, axis=0)
-            class_ids = np.delete(class_ids, exclude_ix, axis=0)
-            scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
+        keep = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0
+        if not keep.all():
+            boxes, class_ids, scores, masks = boxes[keep], class_ids[keep], scores[keep], masks[keep]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1) \
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        full_masks = unmold_masks(masks, boxes, original_image_shape)
 
         return boxes, class_ids, scores, full_masks
 
+    @staticmethod
+    def _results_from_graph(boxes, class_ids, scores, masks):
+        """Strips the zero padding from the outputs of UnmoldLayer.
+
+        Returns a list of dicts, one dict per image. See detect().
+        """
+        results = []
+        for i in range(boxes.shape[0]):
+            # Padding has class ID 0 and is always at the end
+            n = np.count_nonzero(class_ids[i])
+            results.append(
+                    {
+                        "rois": boxes[i, :n],
+                        "class_ids": class_ids[i, :n],
+                        "scores": scores[i, :n],
+                        "masks": masks[i, ..., :n],
+                        }
+                    )
+        return results
+
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
 
@@ -312,22 +496,19 @@ class MaskRCNN:
         # Mold inputs to format expected by the neural network
         molded_images, image_metas, windows = self.mold_inputs(images)
 
-        # Validate image sizes
-        # All images in a batch MUST be of the same size
-        image_shape = molded_images[0].shape
-        for g in molded_images[1:]:
-            assert g.shape == image_shape, \
-                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
+        # All images in a batch have the same size, mold_inputs() validates it
+        image_shape = molded_images.shape[1:]
 
-        # Anchors
+        # Anchors, already duplicated across the batch dimension
         anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        assert anchors.dtype == np.float32
 
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ = \
-            self.keras_model.predict([molded_images, image_metas, anchors])
+        outputs = self._predict(molded_images, image_metas, anchors)
+        if self.config.UNMOLD_IN_GRAPH:
+            return self._results_from_graph(*outputs[7:])
+
+        detections, _, _, mrcnn_mask, _, _, _ = outputs
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -347,13 +528,63 @@ class MaskRCNN:
                     )
         return results
 
+    def _anchors_path(self, shape):
+        """Returns the path of the anchors file for the given (height, width).
+
+        The name includes a hash of the config values anchors depend on, so
+        files generated with another anchor config are never picked up.
+        """
+        params = repr((
+            tuple(self.config.RPN_ANCHOR_SCALES),
+            tuple(self.config.RPN_ANCHOR_RATIOS),
+            tuple(self.config.BACKBONE_STRIDES),
+            self.config.RPN_ANCHOR_STRIDE,
+            ))
+        digest = hashlib.md5(params.encode()).hexdigest()[:8]
+        size = shape if isinstance(shape, str) else '{}x{}'.format(*shape)
+        return os.path.join(self._anchors_dir, 'anchors_{}_{}.npz'.format(size, digest))
+
+    def _save_anchors(self, shape, a):
+        """Saves anchors in pixel coordinates for the given (height, width).
+
+        Writes to a temporary file that is moved into place, so an interrupted
+        write never leaves a truncated file behind. Failing to save is not
+        fatal, the anchors are just generated again on the next run.
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._anchors_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, anchors=a, shape=shape)
+            os.replace(tmp_path, self._anchors_path(shape))
+        except OSError:
+            logger.warning("Failed to save anchors to %s", self._anchors_dir, exc_info=True)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _cache_anchors(self, shape, a):
+        """Caches anchors in pixel coordinates for the given (height, width)."""
+        # Normalize coordinates and broadcast once. Make the result
+        # contiguous float32, as input_anchors is, so neither Keras nor TF
+        # copy or cast it on every call.
+        self._anchor_cache[shape] = np.ascontiguousarray(
+                np.broadcast_to(
+                        norm_boxes(a, shape),
+                        (self.config.BATCH_SIZE,) + a.shape
+                        ),
+                dtype=np.float32
+                )
+
     def get_anchors(self, image_shape):
-        """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
+        """Returns anchor pyramid for the given image size, duplicated across
+        the batch dimension because Keras requires it.
+
+        Returns: [BATCH_SIZE, anchor_count, (y1, x1, y2, x2)] in normalized coordinates
+        """
+        key = tuple(image_shape[:2])
         # Cache anchors and reuse if image shape is the same
-        if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
+        if key not in self._anchor_cache:
+            backbone_shapes = compute_backbone_shapes(self.config, image_shape)
             # Generate Anchors
             a = generate_pyramid_anchors(
                     self.config.RPN_ANCHOR_SCALES,
@@ -365,6 +596,7 @@ class MaskRCNN:
             # Keep a copy of the latest anchors in pixel coordinates because
             # it's used in inspect_model notebooks.
             self.anchors = a
-            # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = norm_boxes(a, image_shape[:2])
-        return self._anchor_cache[tuple(image_shape)]
+            self._cache_anchors(key, a)
+            if self._anchors_dir is not None:
+                self._save_anchors(key, a)
+        return self._anchor_cache[key]
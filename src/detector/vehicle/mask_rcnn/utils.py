@@ -6,6 +6,10 @@ import skimage.color
 import skimage.io
 import skimage.transform
 import tensorflow as tf
+from numba import (
+    njit,
+    prange,
+    )
 
 
 def compute_backbone_shapes(config, image_shape):
@@ -407,6 +411,40 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     return image.astype(image_dtype), window, scale, padding, crop
 
 
+@njit(cache=True)
+def _mask_value(mask, y, x):
+    """Returns mask[y, x], or zero outside of the mask."""
+    if 0 <= y < mask.shape[0] and 0 <= x < mask.shape[1]:
+        return mask[y, x]
+    return 0.
+
+
+@njit(cache=True, parallel=True)
+def _paste_masks(masks, boxes, threshold, out):
+    """Bilinearly resizes each mask to its box and writes the thresholded
+    result into out[i, y1:y2, x1:x2]. Uses pixel centers, zero padding and
+    clipping to the mask's value range, like resize() does.
+    """
+    mask_h, mask_w = masks.shape[1], masks.shape[2]
+    for i in prange(masks.shape[0]):
+        mask = masks[i]
+        lo, hi = mask.min(), mask.max()
+        y1, x1 = boxes[i, 0], boxes[i, 1]
+        box_h, box_w = boxes[i, 2] - y1, boxes[i, 3] - x1
+        for r in range(box_h):
+            src_y = (r + 0.5) * mask_h / box_h - 0.5
+            y0 = int(np.floor(src_y))
+            dy = src_y - y0
+            for c in range(box_w):
+                src_x = (c + 0.5) * mask_w / box_w - 0.5
+                x0 = int(np.floor(src_x))
+                dx = src_x - x0
+                top = (1. - dx) * _mask_value(mask, y0, x0) + dx * _mask_value(mask, y0, x0 + 1)
+                bottom = (1. - dx) * _mask_value(mask, y0 + 1, x0) + dx * _mask_value(mask, y0 + 1, x0 + 1)
+                value = min(max((1. - dy) * top + dy * bottom, lo), hi)
+                out[i, y1 + r, x1 + c] = value >= threshold
+
+
 def unmold_mask(mask, bbox, image_shape):
     """Converts a mask generated by the neural network to a format similar
     to its original shape.
@@ -415,15 +453,115 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
+    return unmold_masks(mask[np.newaxis], np.array([bbox]), image_shape)[..., 0]
+
+
+def unmold_masks(masks, boxes, image_shape):
+    """Converts masks generated by the neural network to a format similar
+    to their original shape.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns binary masks [height, width, N] with the same size as the original image.
+    """
     threshold = 0.5
-    y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
+    # Fill the masks one after another, so each box row is a contiguous strip,
+    # and return an [height, width, N] view of them.
+    full_masks = np.zeros((masks.shape[0],) + tuple(image_shape[:2]), dtype=np.bool)
+    if masks.shape[0] > 0:
+        _paste_masks(
+                np.ascontiguousarray(masks, dtype=np.float32),
+                np.ascontiguousarray(boxes, dtype=np.int32),
+                threshold, full_masks
+                )
+    return np.moveaxis(full_masks, 0, -1)
 
-    # Put the mask in the right location.
-    full_mask = np.zeros(image_shape[:2], dtype=np.bool)
-    full_mask[y1:y2, x1:x2] = mask
-    return full_mask
+
+def unmold_detections_graph(detections, mrcnn_mask, image_meta, config):
+    """Graph version of MaskRCNN.unmold_detections() for a single image.
+
+    detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
+    mrcnn_mask: [N, height, width] masks of the detected classes
+    image_meta: [meta length] Image details. See compose_image_meta()
+
+    Returns, compacted and zero padded to DETECTION_MAX_INSTANCES:
+        boxes: [N, (y1, x1, y2, x2)] int32 bounding boxes in pixels of the original image
+        class_ids: [N] int32 class IDs. Padding has class ID 0.
+        scores: [N] float32 probability scores of the class_id
+        masks: [height, width, N] bool instance masks of the original image size
+    """
+    m = parse_image_meta_graph(image_meta[tf.newaxis])
+    original_shape = tf.cast(m['original_image_shape'][0, :2], tf.float32)
+    window = norm_boxes_graph(m['window'][0], m['image_shape'][0, :2])
+
+    class_ids = tf.cast(detections[:, 4], tf.int32)
+    scores = detections[:, 5]
+
+    # Translate normalized coordinates in the resized image to pixel
+    # coordinates in the original image before resizing
+    wy1, wx1, wy2, wx2 = tf.split(window, 4)
+    shift = tf.concat([wy1, wx1, wy1, wx1], axis=0)
+    scale = tf.concat([wy2 - wy1, wx2 - wx1, wy2 - wy1, wx2 - wx1], axis=0)
+    h, w = tf.split(original_shape, 2)
+    boxes = (detections[:, :4] - shift) / scale
+    boxes = tf.cast(
+            tf.round(boxes * (tf.concat([h, w, h, w], axis=0) - 1.) + tf.constant([0., 0., 1., 1.])),
+            tf.int32
+            )
+
+    # Drop zero padding and detections with zero area
+    keep = tf.where(tf.logical_and(
+            class_ids > 0,
+            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0
+            ))[:, 0]
+    boxes = tf.gather(boxes, keep)
+    class_ids = tf.gather(class_ids, keep)
+    scores = tf.gather(scores, keep)
+    masks = tf.gather(mrcnn_mask, keep)
+
+    # Paste masks into the full image. Sample each mask over the whole image
+    # so that its box maps onto the mask, using pixel centers on both sides.
+    # crop_and_resize() returns extrapolation_value for any sample outside
+    # the mask cell centers, while resize() interpolates the outer half cell
+    # of a box against zero padding. Pad the masks with one zero cell on each
+    # side to do the same.
+    mask_min = tf.reduce_min(masks, axis=[1, 2])[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    mask_max = tf.reduce_max(masks, axis=[1, 2])[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    masks = tf.pad(masks, [(0, 0), (1, 1), (1, 1)])
+    mask_h = tf.cast(tf.shape(masks)[1], tf.float32) - 2.
+    mask_w = tf.cast(tf.shape(masks)[2], tf.float32) - 2.
+    fboxes = tf.cast(boxes, tf.float32)
+    by1, bx1, by2, bx2 = tf.split(fboxes, 4, axis=1)
+    y1 = ((0.5 - by1) / (by2 - by1) * mask_h + 0.5) / (mask_h + 1.)
+    x1 = ((0.5 - bx1) / (bx2 - bx1) * mask_w + 0.5) / (mask_w + 1.)
+    y2 = ((h - 0.5 - by1) / (by2 - by1) * mask_h + 0.5) / (mask_h + 1.)
+    x2 = ((w - 0.5 - bx1) / (bx2 - bx1) * mask_w + 0.5) / (mask_w + 1.)
+    full_masks = tf.image.crop_and_resize(
+            masks[..., tf.newaxis],
+            tf.concat([y1, x1, y2, x2], axis=1),
+            tf.range(tf.shape(masks)[0]),
+            tf.cast(original_shape, tf.int32),
+            extrapolation_value=0
+            )
+    # resize() clips the result to the range of the input mask
+    full_masks = tf.clip_by_value(full_masks, mask_min, mask_max)
+    # Keep the masks inside their boxes, as unmold_masks() does
+    ys = tf.range(tf.cast(h[0], tf.int32))
+    xs = tf.range(tf.cast(w[0], tf.int32))
+    in_rows = tf.logical_and(ys[tf.newaxis] >= boxes[:, 0:1], ys[tf.newaxis] < boxes[:, 2:3])
+    in_cols = tf.logical_and(xs[tf.newaxis] >= boxes[:, 1:2], xs[tf.newaxis] < boxes[:, 3:4])
+    in_boxes = tf.logical_and(in_rows[:, :, tf.newaxis], in_cols[:, tf.newaxis, :])
+    full_masks = tf.logical_and(full_masks[..., 0] >= 0.5, in_boxes)
+    full_masks = tf.transpose(full_masks, [1, 2, 0])
+
+    # Pad with zeros up to DETECTION_MAX_INSTANCES
+    gap = config.DETECTION_MAX_INSTANCES - tf.shape(keep)[0]
+    boxes = tf.pad(boxes, [(0, gap), (0, 0)])
+    class_ids = tf.pad(class_ids, [(0, gap)])
+    scores = tf.pad(scores, [(0, gap)])
+    full_masks = tf.pad(full_masks, [(0, 0), (0, 0), (0, gap)])
+
+    return boxes, class_ids, scores, full_masks
 
 
 def generate_anchors(scales, ratios, shape, feature_stride, anchor_stride):
@@ -510,10 +648,13 @@ def norm_boxes(boxes, shape):
     return np.divide((boxes - shift), scale).astype(np.float32)
 
 
-def denorm_boxes(boxes, shape):
+def denorm_boxes(boxes, shape, out=None):
     """Converts boxes from normalized coordinates to pixel coordinates.
     boxes: [N, (y1, x1, y2, x2)] in normalized coordinates
     shape: [..., (height, width)] in pixels
+    out: Optional float array to do the computation in. Can be boxes itself.
+         Its dtype sets the precision of the scaling and rounding, which
+         otherwise are done in float64.
 
     Note: In pixel coordinates (y2, x2) is outside the box. But in normalized
     coordinates it's inside the box.
@@ -524,7 +665,9 @@ def denorm_boxes(boxes, shape):
     h, w = shape
     scale = np.array([h - 1, w - 1, h - 1, w - 1])
     shift = np.array([0, 0, 1, 1])
-    return np.around(np.multiply(boxes, scale) + shift).astype(np.int32)
+    boxes = np.multiply(boxes, scale, out=out)
+    np.add(boxes, shift, out=boxes)
+    return np.around(boxes, out=boxes).astype(np.int32)
 
 
 def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,